@@ -1,21 +1,145 @@
 import streamlit as st
-from openai import OpenAI
+import httpx
+import orjson
+from openai import AsyncOpenAI
+import asyncio
 import logging
-from typing import Dict, Any, List
+import re
+import tempfile
+import threading
+from collections import OrderedDict, deque
+from typing import AsyncIterator, Dict, Any, Iterator, List, Optional
 import os
 from dotenv import load_dotenv
 
 # Carrega as variáveis de ambiente do arquivo .env
 load_dotenv()
 
+# Resolvida uma única vez no import; evita consultas ao ambiente por rerun
+OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+
+_LOG = logging.getLogger(__name__)
+
+# Quantidade de mensagens renderizadas inline a cada rerun
+_RECENT_WINDOW = 20
+
+# Quantas imagens geradas ficam em memória; as mais antigas vão para disco
+_IMAGE_CACHE_SIZE = 10
+
+# Mensagem de sistema enviada em toda conversa
+_SYSTEM_MSG = {"role": "system", "content": """Você é um assistente prestativo e amigável.
+Você fornece respostas claras e úteis, mantendo um tom profissional e amigável.
+Quando fornecendo exemplos de código, use blocos de código markdown com a linguagem especificada."""}
+
+# Comandos de geração de imagem: captura o prompt no grupo 2
+_IMG_RE = re.compile(r"^/(imagem|img|gerar imagem|criar imagem)\s+(.+)$", re.IGNORECASE | re.DOTALL)
+
+# Janela de coalescência e tamanho máximo de lote do RequestBatcher
+_BATCH_WINDOW = 0.2
+_BATCH_MAX = 8
+
+class RequestBatcher:
+    """Coalesce requisições concorrentes à API em lotes de até 200ms
+
+    Todas as sessões compartilham um único event loop em background. Cada
+    requisição entra numa fila e o worker drena o que chegar dentro da
+    janela, despachando o lote de uma vez com asyncio.gather. Sob vários
+    usuários isso amortiza o overhead do event loop e suaviza picos de
+    requisições por minuto; com um usuário só, adiciona no máximo a janela
+    de espera antes do primeiro token.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.queue: asyncio.Queue = asyncio.Queue()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self._worker(), self.loop)
+
+    async def batch(self, coro):
+        """Enfileira a corrotina no lote atual e aguarda o resultado"""
+        future = self.loop.create_future()
+        self.queue.put_nowait((coro, future))
+        return await future
+
+    async def _worker(self):
+        while True:
+            batch = [await self.queue.get()]
+
+            # Drena o que mais chegar dentro da janela de coalescência
+            deadline = self.loop.time() + _BATCH_WINDOW
+            while len(batch) < _BATCH_MAX:
+                timeout = deadline - self.loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Dispara o lote inteiro concorrentemente
+            results = await asyncio.gather(
+                *(coro for coro, _ in batch), return_exceptions=True
+            )
+            for (_, future), result in zip(batch, results):
+                if isinstance(result, BaseException):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+@st.cache_resource
+def get_request_batcher() -> RequestBatcher:
+    """Retorna o coalescedor de requisições compartilhado entre as sessões"""
+    return RequestBatcher()
+
+def run_async(coro):
+    """Executa uma corrotina no event loop compartilhado e espera o resultado"""
+    return asyncio.run_coroutine_threadsafe(coro, get_request_batcher().loop).result()
+
+@st.cache_resource
+def get_openai_client(api_key: str) -> AsyncOpenAI:
+    """Retorna um cliente OpenAI compartilhado entre todas as sessões
+
+    O cache_resource devolve o mesmo objeto para todas as sessões, o que é
+    seguro para o cliente OpenAI (thread-safe) e reaproveita o pool de
+    conexões HTTP em vez de abrir um novo por sessão.
+    """
+    return AsyncOpenAI(api_key=api_key)
+
+@st.cache_data(show_spinner=False)
+def _fetch_image(url: str) -> bytes:
+    """Baixa a imagem uma única vez; os reruns reutilizam os bytes em cache
+
+    As URLs do DALL-E expiram em cerca de uma hora, então guardar os bytes
+    também evita que imagens antigas quebrem no histórico.
+    """
+    response = httpx.get(url, timeout=30)
+    response.raise_for_status()
+    return response.content
+
 class ChatInterface:
     def __init__(self):
         # Configuração inicial do Streamlit
         st.set_page_config(page_title="Lari Bot", page_icon="🤖", layout="wide")
         
-        # Inicialização do histórico de chat
-        if 'messages' not in st.session_state:
-            st.session_state.messages = []
+        # Histórico de chat serializado como blobs orjson
+        if '_messages_raw' not in st.session_state:
+            st.session_state._messages_raw = []
+
+        # Cache incremental das mensagens já decodificadas
+        if '_messages_cache' not in st.session_state:
+            st.session_state._messages_cache = []
+
+        # Janela móvel já formatada para a API da OpenAI
+        if 'openai_history' not in st.session_state:
+            st.session_state.openai_history = deque(maxlen=5)
+
+        # LRU de bytes de imagem: chave da mensagem -> bytes ou caminho em disco
+        if 'image_store' not in st.session_state:
+            st.session_state.image_store = OrderedDict()
+            st.session_state.image_seq = 0
+            # Diretório atrelado à sessão: quando o session_state é
+            # descartado, o finalizer apaga os arquivos despejados
+            st.session_state.image_tmpdir = tempfile.TemporaryDirectory(prefix="laribot-")
 
     def setup_sidebar(self):
         """Configura a barra lateral com as opções"""
@@ -25,31 +149,100 @@ class ChatInterface:
                 self.clear_conversation()
             
             # Verifica se existe API key no ambiente
-            if not os.getenv('OPENAI_API_KEY'):
+            if not OPENAI_API_KEY:
                 st.error("Por favor, configure a API key no arquivo .env")
                 return False
-            return "gpt-4"
+
+            # Modelos menores geram tokens bem mais rápido nos turnos interativos
+            return st.selectbox("Modelo", ["gpt-4o-mini", "gpt-4o", "gpt-4"], index=0)
 
     def clear_conversation(self):
         """Limpa a conversa"""
-        st.session_state.messages = []
+        st.session_state._messages_raw = []
+        st.session_state._messages_cache = []
+        st.session_state.openai_history.clear()
+
+        # Remove também as imagens despejadas para disco
+        for value in st.session_state.image_store.values():
+            if isinstance(value, str) and os.path.exists(value):
+                os.remove(value)
+        st.session_state.image_store.clear()
+
+    def store_image(self, data: bytes) -> int:
+        """Guarda os bytes de uma imagem e retorna a chave para renderização
+
+        Mantém no máximo _IMAGE_CACHE_SIZE imagens em memória; as mais
+        antigas são gravadas em arquivo temporário e passam a ser
+        referenciadas pelo caminho, limitando o crescimento da sessão.
+        """
+        store = st.session_state.image_store
+        key = st.session_state.image_seq
+        st.session_state.image_seq += 1
+        store[key] = data
+
+        in_memory = [k for k, v in store.items() if isinstance(v, bytes)]
+        while len(in_memory) > _IMAGE_CACHE_SIZE:
+            evicted = in_memory.pop(0)
+            path = os.path.join(st.session_state.image_tmpdir.name, f"{evicted}.png")
+            with open(path, "wb") as spill:
+                spill.write(store[evicted])
+            store[evicted] = path
+
+        return key
+
+    def load_image(self, key: int):
+        """Retorna os bytes em memória ou o caminho em disco de uma imagem"""
+        store = st.session_state.image_store
+        value = store.get(key)
+        if isinstance(value, bytes):
+            # Toque de LRU: imagens ainda visíveis continuam quentes
+            store.move_to_end(key)
+        return value
 
     def get_messages(self) -> List[Dict]:
-        """Retorna as mensagens da conversa"""
-        return st.session_state.messages
+        """Retorna as mensagens da conversa, decodificando só as novas"""
+        raw = st.session_state._messages_raw
+        cache = st.session_state._messages_cache
+        for item in raw[len(cache):]:
+            cache.append(orjson.loads(item))
+        return cache
+
+    def render_message(self, message: Dict):
+        """Renderiza uma mensagem do histórico"""
+        with st.chat_message(message["role"]):
+            if message.get("type") == "image":
+                st.image(self.load_image(message["content"]))
+            elif message.get("type") == "code":
+                st.code(message["content"], language=message.get("language", ""))
+            elif message.get("type") == "blocks":
+                # Blocos já classificados: só despacha, sem re-parsear
+                for block in message["content"]:
+                    if block["type"] == "code":
+                        st.code(block["content"], language=block.get("language", ""))
+                    else:
+                        st.markdown(block["content"])
+            else:
+                st.markdown(message["content"])
 
     def display_chat_history(self):
-        """Mostra o histórico do chat"""
-        for message in self.get_messages():
-            with st.chat_message(message["role"]):
-                if message.get("type") == "image":
-                    st.image(message["content"])
-                elif message.get("type") == "code":
-                    st.code(message["content"], language=message.get("language", ""))
-                else:
-                    st.markdown(message["content"])
+        """Mostra o histórico do chat, limitando o custo por rerun"""
+        messages = self.get_messages()
+        older = messages[:-_RECENT_WINDOW]
+        recent = messages[-_RECENT_WINDOW:]
+
+        # Mensagens antigas só são renderizadas sob demanda
+        if older:
+            with st.expander(f"{len(older)} mensagens antigas"):
+                if not st.session_state.get('show_older') and st.button("Carregar mensagens antigas"):
+                    st.session_state.show_older = True
+                if st.session_state.get('show_older'):
+                    for message in older:
+                        self.render_message(message)
+
+        for message in recent:
+            self.render_message(message)
 
-    def append_chat_message(self, role: str, content: str, msg_type: str = "text", language: str = None):
+    def append_chat_message(self, role: str, content: Any, msg_type: str = "text", language: str = None):
         """Adiciona uma mensagem ao histórico da conversa"""
         message = {
             "role": role,
@@ -58,122 +251,212 @@ class ChatInterface:
         }
         if language:
             message["language"] = language
-        st.session_state.messages.append(message)
+
+        # Imagens ficam no LRU; a mensagem guarda apenas a chave
+        if msg_type == "image":
+            message["content"] = self.store_image(content)
+
+        st.session_state._messages_raw.append(orjson.dumps(message))
+
+        # Mantém a janela móvel no formato da API, evitando o filtro por turno
+        if msg_type in ("text", "code"):
+            st.session_state.openai_history.append({"role": role, "content": content})
+        elif msg_type == "blocks":
+            st.session_state.openai_history.append({
+                "role": role,
+                "content": '\n'.join(block["content"] for block in content)
+            })
 
 class Chatbot:
     def __init__(self, openai_api_key: str):
-        self.client = OpenAI(api_key=openai_api_key)
-        self.logger = logging.getLogger(__name__)
+        self.client = get_openai_client(openai_api_key)
+        self.batcher = get_request_batcher()
 
     def detect_code_blocks(self, text: str) -> List[Dict[str, str]]:
-        """Detecta blocos de código no texto"""
+        """Detecta blocos de código no texto
+
+        Varre o texto inteiro com str.find em vez de quebrá-lo em linhas,
+        fatiando cada segmento direto da string original.
+        """
         blocks = []
-        lines = text.split('\n')
-        in_code_block = False
-        current_block = []
-        current_language = ""
-        
-        for line in lines:
-            if line.startswith('```'):
-                if in_code_block:
-                    blocks.append({
-                        "type": "code",
-                        "content": '\n'.join(current_block),
-                        "language": current_language
-                    })
-                    current_block = []
-                    in_code_block = False
-                else:
-                    language = line[3:].strip()
-                    current_language = language if language else ""
-                    in_code_block = True
-            elif in_code_block:
-                current_block.append(line)
-            else:
-                if line.strip():
-                    blocks.append({
-                        "type": "text",
-                        "content": line
-                    })
-        
+        pos = 0
+        idx = 0
+
+        while (i := text.find('```', idx)) != -1:
+            # Fences só contam no início de linha
+            if i > 0 and text[i - 1] != '\n':
+                idx = i + 3
+                continue
+
+            # Fim da linha do fence (tag de linguagem) e fence de fechamento
+            nl = text.find('\n', i + 3)
+            if nl == -1:
+                break
+            end = text.find('\n```', nl)
+            if end == -1:
+                break
+
+            # Texto entre o fim do bloco anterior e o início deste
+            segment = text[pos:i]
+            if segment.strip():
+                blocks.append({
+                    "type": "text",
+                    "content": segment.strip()
+                })
+
+            blocks.append({
+                "type": "code",
+                "content": text[nl + 1:end].rstrip('\n'),
+                "language": text[i + 3:nl].strip()
+            })
+            pos = idx = end + 4  # pula o '\n```' de fechamento
+
+        # Texto após o último bloco de código
+        segment = text[pos:]
+        if segment.strip():
+            blocks.append({
+                "type": "text",
+                "content": segment.strip()
+            })
+
         return blocks
 
-    def generate_image(self, prompt: str) -> str:
-        """Gera uma imagem usando DALL-E 3"""
+    async def generate_image(self, prompt: str) -> bytes:
+        """Gera uma imagem usando DALL-E 3 e retorna os bytes do PNG"""
         try:
-            response = self.client.images.generate(
+            response = await self.batcher.batch(self.client.images.generate(
                 model="dall-e-3",
                 prompt=prompt,
                 size="1024x1024",
                 quality="standard",
                 n=1,
-            )
-            
-            return response.data[0].url
-            
+            ))
+
+            # O download é bloqueante; roda numa thread para não parar o
+            # event loop compartilhado entre as sessões
+            return await asyncio.to_thread(_fetch_image, response.data[0].url)
+
         except Exception as e:
-            self.logger.error(f"Erro na geração de imagem: {str(e)}")
+            _LOG.error("Erro na geração de imagem: %s", e)
             return None
 
-    def process_message(self, message: str, history: List[Dict], model: str = "gpt-4") -> List[Dict[str, Any]]:
+    async def process_message(self, message: str, history: List[Dict], model: str = "gpt-4o-mini") -> Optional[Dict[str, Any]]:
         """
-        Processa a mensagem do usuário e retorna uma resposta
+        Processa comandos de geração de imagem e retorna uma única resposta
         """
         try:
-            responses = []
-            
             # Verifica se é um pedido de geração de imagem
-            if message.lower().startswith(('/imagem', '/img', '/gerar imagem', '/criar imagem')):
-                image_prompt = message.split(' ', 1)[1]
-                image_url = self.generate_image(image_prompt)
-                if image_url:
-                    responses.append({
+            match = _IMG_RE.match(message)
+            if match:
+                image_bytes = await self.generate_image(match.group(2))
+                if image_bytes:
+                    return {
                         "tipo": "imagem",
-                        "conteudo": image_url
-                    })
-                    return responses
-            
+                        "conteudo": image_bytes
+                    }
+
+            return None
+
+        except Exception as e:
+            _LOG.error("Erro no processamento: %s", e)
+            return {
+                "tipo": "texto",
+                "conteudo": f"Desculpe, ocorreu um erro: {str(e)}"
+            }
+
+    async def stream_message(self, message: str, history: List[Dict], model: str = "gpt-4o-mini") -> AsyncIterator[str]:
+        """
+        Envia a mensagem do usuário para o GPT e gera a resposta token a token
+
+        `history` deve conter mensagens já no formato {"role", "content"} da API.
+        """
+        try:
             # Prepara o histórico para o GPT
-            messages = [
-                {"role": "system", "content": """Você é um assistente prestativo e amigável.
-                 Você fornece respostas claras e úteis, mantendo um tom profissional e amigável.
-                 Quando fornecendo exemplos de código, use blocos de código markdown com a linguagem especificada."""}
-            ]
-            
-            # Adiciona histórico recente
-            for msg in history[-5:]:  # Últimas 5 mensagens
-                if msg['type'] in ['text', 'code']:
-                    messages.append({
-                        "role": msg['role'],
-                        "content": msg['content']
-                    })
-            
+            messages = [_SYSTEM_MSG]
+
+            # Histórico recente já vem formatado para a API
+            messages.extend(history)
+
             # Adiciona mensagem atual
             messages.append({"role": "user", "content": message})
-            
-            # Gera resposta
-            response = self.client.chat.completions.create(
+
+            # A criação do stream passa pelo lote; os tokens chegam direto
+            stream = await self.batcher.batch(self.client.chat.completions.create(
                 model=model,
                 messages=messages,
-                temperature=0.7
-            )
-            
-            # Processa a resposta para identificar blocos de código
-            blocks = self.detect_code_blocks(response.choices[0].message.content)
-            
-            # Retorna os blocos processados
-            return [{
-                "tipo": block["type"],
-                "conteudo": block["content"],
-                "linguagem": block.get("language", "") if block["type"] == "code" else None
-            } for block in blocks]
-                
+                temperature=0.2,
+                stream=True
+            ))
+
+            async for chunk in stream:
+                yield chunk.choices[0].delta.content or ""
+
         except Exception as e:
-            self.logger.error(f"Erro no processamento: {str(e)}")
-            return [{
-                "tipo": "texto",
-                "conteudo": f"Desculpe, ocorreu um erro: {str(e)}"
-            }]
+            _LOG.error("Erro no processamento: %s", e)
+            yield f"Desculpe, ocorreu um erro: {str(e)}"
+
+def stream_sync(agen: AsyncIterator[str]) -> Iterator[str]:
+    """Consome um gerador assíncrono a partir do script síncrono do Streamlit
+
+    Usa o event loop compartilhado para que o stream seja iterado no mesmo
+    loop em que o cliente o criou.
+    """
+    loop = get_request_batcher().loop
+    while True:
+        try:
+            yield asyncio.run_coroutine_threadsafe(agen.__anext__(), loop).result()
+        except StopAsyncIteration:
+            break
+
+@st.fragment
+def chat_turn(interface: ChatInterface, bot: Chatbot, model: str):
+    """Trata um turno do chat como fragmento
+
+    Rodar como fragmento evita re-executar main() (e re-renderizar o
+    histórico inteiro) a cada interação com o st.chat_input; o rerun
+    completo só acontece ao final do turno, quando há mensagens novas.
+    """
+    # Campo de input do usuário
+    if prompt := st.chat_input("Digite sua mensagem... (Use /imagem para gerar imagens)"):
+        # Captura a janela de contexto antes de registrar o turno atual
+        historico = list(st.session_state.openai_history)
+
+        # Adiciona a mensagem do usuário ao histórico
+        interface.append_chat_message("user", prompt)
+
+        # Mostra a mensagem do usuário
+        with st.chat_message("user"):
+            st.markdown(prompt)
+
+        # Gera e mostra a resposta
+        with st.chat_message("assistant"):
+            if _IMG_RE.match(prompt):
+                # Comandos de imagem continuam síncronos
+                response = run_async(bot.process_message(prompt, historico, model))
+
+                # Um único append por turno: um state-diff só
+                if response:
+                    if response["tipo"] == "imagem":
+                        st.image(response["conteudo"])
+                        interface.append_chat_message("assistant", response["conteudo"], "image")
+                    else:
+                        st.markdown(response["conteudo"])
+                        interface.append_chat_message("assistant", response["conteudo"])
+                else:
+                    # Falha na geração: dá retorno em vez de um balão vazio
+                    erro = "Desculpe, não foi possível gerar a imagem."
+                    st.markdown(erro)
+                    interface.append_chat_message("assistant", erro)
+            else:
+                # Mostra a resposta conforme os tokens chegam
+                full_text = st.write_stream(stream_sync(bot.stream_message(prompt, historico, model)))
+
+                # Persiste os blocos já classificados em uma única mensagem
+                blocks = bot.detect_code_blocks(full_text)
+                interface.append_chat_message("assistant", blocks, "blocks")
+
+        # Sincroniza o histórico renderizado fora do fragmento
+        st.rerun(scope="app")
 
 def main():
     """Função principal da interface"""
@@ -188,39 +471,14 @@ def main():
     # Título da aplicação
     st.title("🤖 Lari Bot")
     
-    # Inicializa o bot se ainda não foi inicializado
-    if 'bot' not in st.session_state:
-        st.session_state.bot = Chatbot(os.getenv('OPENAI_API_KEY'))
+    # O bot é um invólucro leve sobre o cliente compartilhado em cache
+    bot = Chatbot(OPENAI_API_KEY)
     
     # Mostra o histórico do chat
     interface.display_chat_history()
-    
-    # Campo de input do usuário
-    if prompt := st.chat_input("Digite sua mensagem... (Use /imagem para gerar imagens)"):
-        # Adiciona a mensagem do usuário ao histórico
-        interface.append_chat_message("user", prompt)
-        
-        # Mostra a mensagem do usuário
-        with st.chat_message("user"):
-            st.markdown(prompt)
-        
-        # Processa a mensagem com contexto
-        historico = interface.get_messages()
-        
-        # Gera e mostra a resposta
-        with st.chat_message("assistant"):
-            responses = st.session_state.bot.process_message(prompt, historico, model)
-            
-            for response in responses:
-                if response["tipo"] == "imagem":
-                    st.image(response["conteudo"])
-                    interface.append_chat_message("assistant", response["conteudo"], "image")
-                elif response["tipo"] == "code":
-                    st.code(response["conteudo"], language=response.get("linguagem", ""))
-                    interface.append_chat_message("assistant", response["conteudo"], "code", response.get("linguagem"))
-                else:
-                    st.markdown(response["conteudo"])
-                    interface.append_chat_message("assistant", response["conteudo"])
+
+    # Input e resposta rodam como fragmento, sem re-executar o histórico
+    chat_turn(interface, bot, model)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file